@@ -1,14 +1,34 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import functools
+import os
 import re
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pybaseball import statcast
 import snowflake.connector
-from snowflake.connector.pandas_tools import write_pandas
+
+# Column-label normalization: spaces -> underscores in one table lookup
+_COL_TRANS = str.maketrans({' ': '_'})
+
+# -------------- Weather string patterns --------------
+_TEMP_RE = re.compile(r'(\d{2,3})\s*[OI°]?\s')
+_WV_RE = re.compile(r'\d{2,3}\s*([OI])\s')
+_WFD_RE = re.compile(r'\s([A-Z]{2})\s*\d')
+_MPH_RANGE_RE = re.compile(r'(\d{1,3})\s*-\s*(\d{1,3})')
+_MPH_SINGLE_RE = re.compile(r'([1-9][0-9]?)\s*(?:mph)?')
+_HUM_RE = re.compile(r'(\d{1,3})%')
 
 # -------------- Connect & Set Schema --------------
-@st.experimental_singleton
+@st.cache_resource(show_spinner=False)
 def get_snowflake_conn():
     conn = snowflake.connector.connect(
         user=st.secrets["snowflake"]["user"],
@@ -18,6 +38,8 @@ def get_snowflake_conn():
         database=st.secrets["snowflake"]["database"],
         schema=st.secrets["snowflake"]["schema"],  # set schema here, casing doesn't matter here
         autocommit=False,  # We'll manually commit DDL
+        client_session_keep_alive=True,  # cached across reruns, don't let the session expire
+        paramstyle='qmark',  # server-side binding; the default pyformat interpolates values client-side
     )
     with conn.cursor() as cur:
         cur.execute(f"USE SCHEMA {st.secrets['snowflake']['schema'].upper()}")
@@ -25,40 +47,180 @@ def get_snowflake_conn():
 
 conn = get_snowflake_conn()
 
+@st.cache_resource(show_spinner=False)
+def get_upload_lock():
+    # The cached connection is shared by every browser session; uploads are serialized end to end on it
+    return threading.Lock()
+
 # === Utility functions ===
 
+def with_retries(attempts=3, base_delay=1.0):
+    """Retry the wrapped call with exponential backoff, re-raising after the last attempt."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            for attempt in range(attempts):
+                try:
+                    return fn(*args, **kwargs)
+                except Exception:
+                    if attempt == attempts - 1:
+                        raise
+                    time.sleep(base_delay * 2 ** attempt)
+        return wrapper
+    return decorator
+
+@with_retries()
+def statcast_day(day):
+    # One day per call; parallelism comes from fetch_statcast's pool, not pybaseball's own
+    return statcast(day, day, verbose=False, parallel=False)
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_statcast(start, end):
+    """Normalized, shrunk Statcast events for [start, end] (ISO date strings), memoized across reruns.
+
+    Days are fetched in parallel; column cleanup, downcasting and date parsing run once per range.
+    """
+    days = pd.date_range(start, end).strftime('%Y-%m-%d')
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        parts = [p for p in ex.map(statcast_day, days) if not p.empty]
+    if not parts:
+        return pd.DataFrame()
+    df = pd.concat(parts, ignore_index=True)
+    df.columns = df.columns.str.strip().str.lower().str.translate(_COL_TRANS)
+    df = df_shrink(df)
+    # Plain dates so Parquet carries a DATE32 column straight into Snowflake's DATE
+    df['game_date'] = pd.to_datetime(df['game_date'], errors='coerce').dt.date
+    return df
+
 def dedup_columns(df):
-    return df.loc[:, ~df.columns.duplicated()]
+    # Keep the first position of each label; return df untouched when there are no dupes
+    seen = {}
+    keep = [i for i, c in enumerate(df.columns) if seen.setdefault(c, i) == i]
+    return df if len(keep) == len(df.columns) else df.iloc[:, keep]
 
-def downcast_numeric(df):
+def df_shrink(df, cat_ratio=0.5, int2uint=True):
+    # Integer counters with gaps (balls, outs_on_play, ...) load as float64; use nullable ints instead
     for col in df.select_dtypes(include=['float']):
-        df[col] = pd.to_numeric(df[col], downcast='float')
+        vals = df[col].dropna()
+        # Only whole numbers below 2**53 are exact in float64; larger ones would wrap in Int64
+        if len(vals) and (vals % 1 == 0).all() and vals.abs().max() < 2**53:
+            downcast = 'unsigned' if int2uint and vals.min() >= 0 else 'integer'
+            df[col] = pd.to_numeric(df[col].astype('Int64'), downcast=downcast)
     for col in df.select_dtypes(include=['int']):
         df[col] = pd.to_numeric(df[col], downcast='integer')
-    return df
+    if int2uint:
+        for col in df.select_dtypes(include=['integer']):
+            col_min = df[col].min()
+            if pd.notna(col_min) and col_min >= 0:
+                df[col] = pd.to_numeric(df[col], downcast='unsigned')
+    # Repeated strings (pitch_type, stand, home_team, ...) become int codes + a small dictionary
+    n = len(df)
+    for col in df.select_dtypes(include=['object', 'string']):
+        if n and df[col].nunique(dropna=False) / n < cat_ratio:
+            df[col] = df[col].astype('category')
+    # Per-column reassignment leaves one block per column; copy() consolidates them into
+    # one block per dtype, each column contiguous, so column-wise reductions stay vectorized
+    return df.copy()
+
+def parse_weather(series):
+    """Vectorized weather_str parser; returns one DataFrame row per input row."""
+    s = series.astype(str).where(series.notna())
+    temp = pd.to_numeric(s.str.extract(_TEMP_RE, expand=False), downcast='integer')
+    wind_vector = s.str.extract(_WV_RE, expand=False)
+    wind_field_dir = s.str.extract(_WFD_RE, expand=False)
+    mph = s.str.extract(_MPH_RANGE_RE)
+    wind_mph = ((mph[0].astype(float) + mph[1].astype(float)) / 2).combine_first(
+        s.str.extract(_MPH_SINGLE_RE, expand=False).astype(float))
+    humidity = pd.to_numeric(s.str.extract(_HUM_RE, expand=False), downcast='integer')
+    low = s.str.lower()
+    condition = (pd.Series(np.nan, index=s.index, dtype=object)
+                 .mask(low.str.contains('indoor', na=False), 'indoor')
+                 .mask(low.str.contains('outdoor', na=False), 'outdoor'))
+    # NaN unless both parts were found (str.cat propagates NaN), rather than 'nan LF' / 'I nan'
+    wind_dir_string = wind_vector.str.cat(wind_field_dir, sep=' ')
+    return pd.DataFrame({
+        'temp': temp, 'wind_vector': wind_vector, 'wind_field_dir': wind_field_dir, 'wind_mph': wind_mph,
+        'humidity': humidity, 'condition': condition, 'wind_dir_string': wind_dir_string,
+    }, index=s.index)
 
-def parse_custom_weather_string_v2(s):
-    if pd.isna(s):
-        return pd.Series([np.nan]*7, index=['temp','wind_vector','wind_field_dir','wind_mph','humidity','condition','wind_dir_string'])
-    s = str(s)
-    temp_match = re.search(r'(\d{2,3})\s*[OI°]?\s', s)
-    temp = int(temp_match.group(1)) if temp_match else np.nan
-    wind_vector_match = re.search(r'\d{2,3}\s*([OI])\s', s)
-    wind_vector = wind_vector_match.group(1) if wind_vector_match else np.nan
-    wind_field_dir_match = re.search(r'\s([A-Z]{2})\s*\d', s)
-    wind_field_dir = wind_field_dir_match.group(1) if wind_field_dir_match else np.nan
-    mph = re.search(r'(\d{1,3})\s*-\s*(\d{1,3})', s)
-    if mph:
-        wind_mph = (int(mph.group(1)) + int(mph.group(2))) / 2
-    else:
-        mph = re.search(r'([1-9][0-9]?)\s*(?:mph)?', s)
-        wind_mph = int(mph.group(1)) if mph else np.nan
-    humidity_match = re.search(r'(\d{1,3})%', s)
-    humidity = int(humidity_match.group(1)) if humidity_match else np.nan
-    condition = "outdoor" if "outdoor" in s.lower() else ("indoor" if "indoor" in s.lower() else np.nan)
-    wind_dir_string = f"{wind_vector} {wind_field_dir}".strip()
-    return pd.Series([temp, wind_vector, wind_field_dir, wind_mph, humidity, condition, wind_dir_string],
-                     index=['temp','wind_vector','wind_field_dir','wind_mph','humidity','condition','wind_dir_string'])
+def as_arrow(data):
+    """Arrow table for a DataFrame (index dropped); Arrow tables pass through."""
+    return pa.Table.from_pandas(data, preserve_index=False) if isinstance(data, pd.DataFrame) else data
+
+def to_csv_bytes(data):
+    """Serialize a DataFrame or Arrow table to UTF-8 CSV bytes with Arrow's C++ writer."""
+    buf = pa.BufferOutputStream()
+    pacsv.write_csv(as_arrow(data), buf)
+    return buf.getvalue().to_pybytes()
+
+def upload_via_parquet(conn, data, table, replace=False, chunk_bytes=100 * 1024 * 1024, parallel=16):
+    """Bulk-load a DataFrame or Arrow table via Parquet files, PUT per file and one COPY INTO. Returns rows loaded.
+
+    With replace=True the table is truncated in the same transaction as the COPY,
+    so readers never see an empty table.
+    """
+    tbl = as_arrow(data)
+    if tbl.num_rows == 0 and not replace:
+        return 0
+    # Unique path per upload so concurrent sessions never see or remove each other's files
+    stage_path = f"@{table}_STAGE/{uuid.uuid4().hex}/"
+    # Split into roughly chunk_bytes-sized files so encoding and uploading can overlap
+    nchunks = max(1, -(-tbl.nbytes // chunk_bytes))
+    rows_per_chunk = max(1, -(-tbl.num_rows // nchunks))
+
+    with tempfile.TemporaryDirectory() as tmp, conn.cursor() as cur:
+        def write_chunk(i, start):
+            path = os.path.join(tmp, f"{table.lower()}_{i:04d}.parquet")
+            pq.write_table(tbl.slice(start, rows_per_chunk), path, compression='snappy')
+            return path
+
+        def put_chunk(path):
+            with conn.cursor() as put_cur:
+                put_cur.execute(f"PUT 'file://{path}' {stage_path} PARALLEL={parallel} AUTO_COMPRESS=FALSE")
+
+        # Everything from the stage DDL to COMMIT runs under the lock: the cached connection is one
+        # Snowflake session shared by all browser sessions, and DDL implicitly commits any open
+        # transaction, so another upload's CREATE STAGE must never land between TRUNCATE and COMMIT
+        with get_upload_lock():
+            # Stage DDL commits implicitly, so it has to run before the transaction starts
+            cur.execute(f"CREATE TEMP STAGE IF NOT EXISTS {table}_STAGE")
+            try:
+                # Each chunk is PUT as soon as it is on disk while later chunks are still being encoded
+                with ThreadPoolExecutor(max_workers=2) as writers, ThreadPoolExecutor(max_workers=4) as putters:
+                    written = [writers.submit(write_chunk, i, start)
+                               for i, start in enumerate(range(0, tbl.num_rows, rows_per_chunk))]
+                    puts = [putters.submit(put_chunk, f.result()) for f in written]
+                    for f in puts:
+                        f.result()
+
+                cur.execute("BEGIN")
+                try:
+                    if replace:
+                        # TRUNCATE is DML in Snowflake, so it rolls back with a failed load
+                        cur.execute(f"TRUNCATE TABLE {table}")
+                    nrows = 0
+                    if tbl.num_rows:
+                        cur.execute(
+                            f"COPY INTO {table} FROM {stage_path} "
+                            f"FILE_FORMAT=(TYPE=PARQUET) MATCH_BY_COLUMN_NAME=CASE_INSENSITIVE PURGE=TRUE"
+                        )
+                        # One row per file with a rows_loaded column; a lone status row when no files were loaded
+                        cols = [d[0].lower() for d in cur.description]
+                        rows = cur.fetchall()
+                        if 'rows_loaded' in cols:
+                            i = cols.index('rows_loaded')
+                            nrows = sum(row[i] for row in rows)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            finally:
+                # PURGE only covers a successful COPY; a failed cleanup must not mask the original error
+                try:
+                    cur.execute(f"REMOVE {stage_path}")
+                except Exception:
+                    pass
+        return nrows
 
 # === Streamlit UI and logic ===
 
@@ -81,7 +243,7 @@ if start_date > end_date:
 if st.button("Fetch Event Data"):
     with st.spinner(f"Fetching Statcast data from {start_date} to {end_date}..."):
         try:
-            df_events = statcast(start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
+            df_events = fetch_statcast(start_date.isoformat(), end_date.isoformat())
             if df_events.empty:
                 st.warning("No data fetched for this date range.")
                 st.stop()
@@ -91,26 +253,21 @@ if st.button("Fetch Event Data"):
 
     st.success(f"Fetched {len(df_events):,} rows of raw event data.")
 
-    df_events.columns = [c.strip().lower().replace(" ", "_") for c in df_events.columns]
-    df_events['game_date'] = pd.to_datetime(df_events['game_date'], errors='coerce').dt.strftime('%Y-%m-%d')
+    # One Arrow copy drives the preview, the CSV download and the Parquet upload
+    tbl_events = as_arrow(df_events)
 
-    st.dataframe(df_events.head(20))
+    st.dataframe(tbl_events.slice(0, 20))
 
-    csv_bytes = df_events.to_csv(index=False).encode('utf-8')
-    st.download_button("Download Raw Event Data CSV", csv_bytes, file_name="statcast_raw_event_data.csv")
+    # Callable data: the CSV is only built when the button is clicked
+    st.download_button("Download Raw Event Data CSV", functools.partial(to_csv_bytes, tbl_events),
+                       file_name="statcast_raw_event_data.csv")
 
     if 'df_events' in locals() and st.button("Upload Event Data to Snowflake"):
         with st.spinner("Uploading event data to Snowflake..."):
             try:
-                with conn.cursor() as cur:
-                    cur.execute("TRUNCATE TABLE event_level_data")
-                # Snowflake likes uppercase columns
-                df_events.columns = [c.upper() for c in df_events.columns]
-                success, nchunks, nrows, _ = write_pandas(conn, df_events, 'EVENT_LEVEL_DATA')
-                if success:
-                    st.success(f"Uploaded {nrows:,} rows of event data to Snowflake.")
-                else:
-                    st.error("Upload failed.")
+                # COPY matches column names case-insensitively, no need to uppercase first
+                nrows = upload_via_parquet(conn, tbl_events, 'EVENT_LEVEL_DATA', replace=True)
+                st.success(f"Uploaded {nrows:,} rows of event data to Snowflake.")
             except Exception as e:
                 st.error(f"Upload error: {e}")
 
@@ -122,7 +279,7 @@ matchups_file = st.file_uploader("Upload Matchups CSV", type="csv", key="matchup
 
 if matchups_file:
     try:
-        df_matchups = pd.read_csv(matchups_file)
+        df_matchups = pd.read_csv(matchups_file, engine='pyarrow', dtype_backend='numpy_nullable')
     except Exception as e:
         st.error(f"Error reading matchup CSV: {e}")
         df_matchups = None
@@ -130,11 +287,11 @@ if matchups_file:
     if df_matchups is not None:
         # Minimal preprocessing for memory efficiency
         df_matchups = dedup_columns(df_matchups)
-        df_matchups = downcast_numeric(df_matchups)
+        df_matchups = df_shrink(df_matchups)
 
         # Parse weather_str column if present
         if 'weather_str' in df_matchups.columns:
-            weather_parsed = df_matchups['weather_str'].apply(parse_custom_weather_string_v2)
+            weather_parsed = parse_weather(df_matchups['weather_str'])
             df_matchups = pd.concat([df_matchups, weather_parsed], axis=1)
 
         st.dataframe(df_matchups.head(20))
@@ -142,14 +299,9 @@ if matchups_file:
         if df_matchups is not None and st.button("Upload Matchups to Snowflake"):
             with st.spinner("Uploading matchup data to Snowflake..."):
                 try:
-                    with conn.cursor() as cur:
-                        cur.execute("TRUNCATE TABLE matchups")
-                    df_matchups.columns = [c.upper() for c in df_matchups.columns]
-                    success, nchunks, nrows, _ = write_pandas(conn, df_matchups, 'MATCHUPS')
-                    if success:
-                        st.success(f"Uploaded {nrows:,} rows to matchups table.")
-                    else:
-                        st.error("Matchup upload failed.")
+                    # COPY matches column names case-insensitively, no need to uppercase first
+                    nrows = upload_via_parquet(conn, df_matchups, 'MATCHUPS', replace=True)
+                    st.success(f"Uploaded {nrows:,} rows to matchups table.")
                 except Exception as e:
                     st.error(f"Upload error: {e}")
 
@@ -162,14 +314,16 @@ with st.form("enriched_feature_form"):
     submitted = st.form_submit_button("Fetch Enriched Features")
 
 if submitted:
-    query = f"""
-        SELECT * FROM today_features WHERE game_date = '{feature_date.strftime('%Y-%m-%d')}'
+    query = """
+        SELECT * FROM today_features WHERE game_date = ?
     """
     try:
-        df_features = pd.read_sql(query, conn)
+        with conn.cursor() as cur:
+            cur.execute(query, (feature_date,))
+            df_features = cur.fetch_pandas_all()
         st.write(f"Downloaded {len(df_features):,} rows of features for {feature_date}")
         st.dataframe(df_features.head(20))
-        csv_bytes = df_features.to_csv(index=False).encode('utf-8')
-        st.download_button("Download Features CSV", csv_bytes, file_name=f"today_features_{feature_date}.csv")
+        st.download_button("Download Features CSV", functools.partial(to_csv_bytes, df_features),
+                           file_name=f"today_features_{feature_date}.csv")
     except Exception as e:
         st.error(f"Error fetching features: {e}")